@@ -84,7 +84,8 @@ def load(
     model = Transformer(model_args)
     model.load_state_dict(checkpoint, strict=False)
     model.eval()
-    model.half()
+    # parameters are already fp16 because of the default tensor type above
+    assert next(model.parameters()).dtype == torch.float16
 
     generator = LLaMA(model, tokenizer)
     print(f"Loaded in {time.time() - start_time:.2f} seconds")
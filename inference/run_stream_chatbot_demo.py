@@ -1,14 +1,18 @@
 """Chatbot Demo for Dromedary"""
 
+import datetime
 import functools
+import re
 from typing import Tuple
 import os
+import numpy as np
 import torch
 import fire
 import time
 import json
 import threading
 import queue
+import traceback
 from pathlib import Path
 
 import gradio as gr
@@ -16,9 +20,22 @@ import gradio as gr
 from fairscale.nn.model_parallel import initialize as mpu
 from fairscale.nn.model_parallel.initialize import initialize_model_parallel
 
+# number of float32 slots per request in the header broadcast from rank 0
+REQUEST_HEADER_FIELDS = 4
+# decode the streamed tokens once this many new tokens are available, or this many seconds after the last decode
+STREAM_DECODE_CHUNK = 8
+STREAM_DECODE_INTERVAL = 0.03
+# "### User" stop marker, or a partial one at the end of a streamed output
+STOP_PATTERN = re.compile(r"### User|\n\n#{1,3}\Z")
+# the other ranks wait for the next request inside the header broadcast, which must not time out
+# while the demo is idle. Only the process group of the header broadcast uses it.
+IDLE_TIMEOUT = datetime.timedelta(days=365)
+
 use_llama_dromedary = False
 try:
     from llama_dromedary import ModelArgs, Transformer, Tokenizer, LLaMA
+    from llama_dromedary.utils import broadcast_checkpoint, load_checkpoint
+    from llama_dromedary.quantization import quantize_model
     use_llama_dromedary = True
 except:
     from llama import ModelArgs, Transformer, Tokenizer, LLaMA
@@ -46,30 +63,31 @@ def setup_model_parallel() -> Tuple[int, int]:
     return global_rank, world_size
 
 
-def load(
+def load_transformer(
     ckpt_dir: str,
-    tokenizer_path: str,
+    tokenizer: Tokenizer,
     global_rank: int,
     world_size: int,
     max_seq_len: int,
     max_batch_size: int,
     max_shared_seq_len: int,
-) -> LLaMA:
-    start_time = time.time()
+    use_torch_compile: bool = False,
+    use_flash_attn: bool = False,
+    broadcast_load: bool = False,
+) -> Transformer:
     checkpoints = sorted(Path(ckpt_dir).glob("*.pth"))
     assert world_size == len(
         checkpoints
     ), f"Loading a checkpoint for MP={len(checkpoints)} but world size is {world_size}"
     ckpt_path = checkpoints[global_rank]
-    print("Loading")
-    checkpoint = torch.load(ckpt_path, map_location="cpu")
+    if broadcast_load and not use_llama_dromedary:
+        raise ValueError("Broadcast loading is only supported with llama_dromedary")
     with open(Path(ckpt_dir) / "params.json", "r") as f:
         params = json.loads(f.read())
 
     model_args: ModelArgs = ModelArgs(
         max_seq_len=max_seq_len, max_batch_size=max_batch_size, **params
     )
-    tokenizer = Tokenizer(model_path=tokenizer_path)
 
     if use_llama_dromedary:
       model_args.vocab_size = tokenizer.n_words
@@ -79,14 +97,65 @@ def load(
           print("New n_heads:", model_args.n_heads)
       model_args.max_shared_seq_len = max_shared_seq_len
       model_args.use_prefix_cache = True
+      model_args.use_torch_compile = use_torch_compile
+      model_args.use_flash_attn = use_flash_attn
 
     torch.set_default_tensor_type(torch.cuda.HalfTensor)
     model = Transformer(model_args)
-    model.load_state_dict(checkpoint, strict=False)
+    if use_llama_dromedary and broadcast_load and world_size > 1:
+        broadcast_checkpoint(model, checkpoints, global_rank)
+    elif use_llama_dromedary:
+        load_checkpoint(model, ckpt_path)
+    else:
+        checkpoint = torch.load(ckpt_path, map_location="cpu")
+        model.load_state_dict(checkpoint, strict=False)
     model.eval()
-    model.half()
+    # parameters are already fp16 because of the default tensor type above
+    assert next(model.parameters()).dtype == torch.float16
+    return model
+
+
+def load(
+    ckpt_dir: str,
+    tokenizer_path: str,
+    global_rank: int,
+    world_size: int,
+    max_seq_len: int,
+    max_batch_size: int,
+    max_shared_seq_len: int,
+    quantization: str = "none",
+    draft_ckpt_dir: str = "none",
+    num_speculative_tokens: int = 4,
+    use_torch_compile: bool = False,
+    use_flash_attn: bool = False,
+    broadcast_load: bool = False,
+) -> LLaMA:
+    start_time = time.time()
+    print("Loading")
+    tokenizer = Tokenizer(model_path=tokenizer_path)
+    model = load_transformer(
+        ckpt_dir, tokenizer, global_rank, world_size, max_seq_len, max_batch_size, max_shared_seq_len,
+        use_torch_compile=use_torch_compile, use_flash_attn=use_flash_attn,
+        broadcast_load=broadcast_load,
+    )
 
-    generator = LLaMA(model, tokenizer)
+    if quantization != "none":
+        if not use_llama_dromedary:
+            raise ValueError("Quantization is only supported with llama_dromedary")
+        model = quantize_model(model, quantization)
+
+    if draft_ckpt_dir == "none":
+        generator = LLaMA(model, tokenizer)
+    else:
+        if not use_llama_dromedary:
+            raise ValueError("Speculative decoding is only supported with llama_dromedary")
+        # the draft model only serves single-prompt batches
+        draft_model = load_transformer(
+            draft_ckpt_dir, tokenizer, global_rank, world_size, max_seq_len, 1, max_shared_seq_len,
+            use_torch_compile=use_torch_compile, use_flash_attn=use_flash_attn,
+            broadcast_load=broadcast_load,
+        )
+        generator = LLaMA(model, tokenizer, draft_model=draft_model, num_speculative_tokens=num_speculative_tokens)
     print(f"Loaded in {time.time() - start_time:.2f} seconds")
     return generator
 
@@ -105,6 +174,12 @@ def main(
     max_shared_seq_len: int = 512,
     meta_prompt_file: str = "none",
     prompt_version: str = "dromedary",
+    quantization: str = "none",
+    draft_ckpt_dir: str = "none",
+    num_speculative_tokens: int = 4,
+    use_torch_compile: bool = False,
+    use_flash_attn: bool = False,
+    broadcast_load: bool = False,
 ):
     if meta_prompt_file != "none":
         with open(meta_prompt_file, "r") as f:
@@ -124,12 +199,134 @@ def main(
     t0 = time.time()
     generator = load(
         ckpt_dir, tokenizer_path, global_rank, world_size, max_seq_len, max_batch_size, max_shared_seq_len,
+        quantization=quantization, draft_ckpt_dir=draft_ckpt_dir, num_speculative_tokens=num_speculative_tokens,
+        use_torch_compile=use_torch_compile, use_flash_attn=use_flash_attn,
+        broadcast_load=broadcast_load,
     )
     t1 = time.time()
     loading_time = t1-t0
     global_rank = torch.distributed.get_rank()
     print("Model loading time on %d: " % global_rank, loading_time)
 
+    # buffers for syncing requests across processes, allocated once and reused for every batch
+    # header layout: [batch size, (prompt length, temperature, top_p, max_new_tokens) * max_batch_size]
+    max_prompt_len = max_seq_len + max_shared_seq_len
+    header_buffer = torch.zeros(1 + REQUEST_HEADER_FIELDS * max_batch_size, dtype=torch.float, device="cuda")
+    prompt_buffer = torch.zeros(max_batch_size * max_prompt_len, dtype=torch.int32, device="cuda")
+    # pinned host staging buffers for the header and the prompt token ids on rank 0
+    host_header_buffer = torch.zeros(header_buffer.shape[0], dtype=torch.float, device="cpu", pin_memory=True)
+    host_prompt_buffer = torch.zeros(max_batch_size * max_prompt_len, dtype=torch.int32, device="cpu", pin_memory=True)
+    # a dedicated group for the header broadcast, so that the model collectives keep the default timeout
+    header_group = torch.distributed.new_group(timeout=IDLE_TIMEOUT)
+
+    def parse_header():
+        header = header_buffer.tolist()
+        batch_size = int(header[0])
+        requests = [
+            header[1 + i * REQUEST_HEADER_FIELDS: 1 + (i + 1) * REQUEST_HEADER_FIELDS] for i in range(batch_size)
+        ]
+        lengths = [int(r[0]) for r in requests]
+        temperatures = [r[1] for r in requests]
+        top_ps = [r[2] for r in requests]
+        max_new_tokens = [int(r[3]) for r in requests]
+        return lengths, temperatures, top_ps, max_new_tokens
+
+    def generate_batch(prompt_tokens, temperatures, top_ps, max_new_tokens, stream_queues=None):
+        generator.generate(
+            prompt_tokens,
+            max_gen_len=max_new_tokens,
+            temperature=temperatures,
+            top_p=top_ps,
+            stop="### User",
+            unitoken_frequency_penalty=0.3,
+            stream_queue=stream_queues,
+            # the meta prompt and the chat history so far are usually still in the prefix cache
+            reuse_prefix_cache=True,
+        )
+
+    def sync_and_generate(requests):
+        # start the asynchronous copy of the prompt token ids first, so that it overlaps with the header
+        prompt_tokens = [request[0] for request in requests]
+        total_length = sum(len(t) for t in prompt_tokens)
+        host_prompt_buffer[:total_length].copy_(
+            torch.from_numpy(np.concatenate([np.asarray(t, dtype=np.int32) for t in prompt_tokens])))
+        prompt_tensor = prompt_buffer[:total_length]
+        prompt_tensor.copy_(host_prompt_buffer[:total_length], non_blocking=True)
+
+        # sync the batch across all processes with a single header broadcast, which also wakes up the
+        # other processes waiting in `run_fake_evaluate`.
+        header = host_header_buffer.numpy()
+        header[:] = 0.0
+        header[0] = len(requests)
+        for i, (tokenized_prompt, temperature, top_p, max_new_tokens, _) in enumerate(requests):
+            header[1 + i * REQUEST_HEADER_FIELDS: 1 + (i + 1) * REQUEST_HEADER_FIELDS] = [
+                len(tokenized_prompt), temperature, top_p, max_new_tokens]
+        header_buffer.copy_(host_header_buffer, non_blocking=True)
+
+        # then exactly sum(lengths) prompt token ids. The other ranks need the header to size the prompt
+        # tensor, but rank 0 knows both sizes, so it launches both broadcasts back to back and waits once.
+        broadcast_works = [
+            torch.distributed.broadcast(header_buffer, 0, group=header_group, async_op=True),
+            torch.distributed.broadcast(prompt_tensor, 0, async_op=True),
+        ]
+
+        # use the float32 values on rank 0 as well, so that sampling is identical on all processes
+        _, temperatures, top_ps, max_new_tokens = parse_header()
+        for work in broadcast_works:
+            work.wait()
+
+        generate_batch(
+            prompt_tokens, temperatures, top_ps, max_new_tokens,
+            stream_queues=[request[-1] for request in requests],
+        )
+
+    # pending requests from the gradio workers, batched by `run_scheduler` on rank 0
+    request_queue = queue.Queue()
+
+    def fits_in_one_batch(requests):
+        # LLaMA.generate only caches the prefix shared by all prompts, and every prompt can only use
+        # max_seq_len positions after it, so long prompts must not be batched with unrelated ones.
+        prompt_tokens = [request[0] for request in requests]
+        shared_len = min(
+            len(os.path.commonprefix(prompt_tokens)),
+            max(min(len(t) for t in prompt_tokens) - 2, 0),
+            max_shared_seq_len,
+        )
+        return all(
+            len(tokenized_prompt) - shared_len + max_new_tokens <= max_seq_len
+            for tokenized_prompt, _, _, max_new_tokens, _ in requests
+        )
+
+    def run_scheduler():
+        torch.cuda.set_device(header_buffer.device)
+        # requests that did not fit in the previous batch go first
+        deferred = []
+        while True:
+            candidates = deferred if deferred else [request_queue.get()]
+            while True:
+                try:
+                    candidates.append(request_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            requests, deferred = [], []
+            for request in candidates:
+                if len(requests) == 0 or (
+                        len(requests) < max_batch_size and fits_in_one_batch(requests + [request])):
+                    requests.append(request)
+                else:
+                    deferred.append(request)
+
+            try:
+                sync_and_generate(requests)
+            except Exception:
+                # keep serving the next requests, and end the streams of this batch so that its users
+                # do not wait forever
+                print("Generation failed for a batch of %d requests:" % len(requests))
+                traceback.print_exc()
+                for request in requests:
+                    request[-1].put(None)
+
     def evaluate(
         prompt,
         temperature=0.1,
@@ -137,103 +334,70 @@ def main(
         max_new_tokens=128,
         **kwargs,
     ):
-        # sync the process with torch.distributed.barrier
-        # torch.distributed.barrier()
-        for i in range(world_size):
-            if i != 0:
-                torch.distributed.send(torch.tensor([1]), dst=i)
-
-        # sync the prompt string across all processes, max_len=4096
-        prompt_tensor = torch.zeros(4096, dtype=torch.long, device="cuda") + generator.tokenizer.pad_id
-        tokenized_prompt = generator.tokenizer.encode(prompt, bos=True, eos=False)
-        prompt_tensor[:len(tokenized_prompt)] = torch.tensor(tokenized_prompt, dtype=torch.long, device="cuda")
-        torch.distributed.broadcast(prompt_tensor, 0)
-        t = prompt_tensor.tolist()
-        try:
-            t = t[: t.index(generator.tokenizer.pad_id)]
-        except ValueError:
-            pass
-        prompt = generator.tokenizer.decode(t)
-
-        temperature_tensor = torch.tensor([temperature], dtype=torch.float, device="cuda")
-        torch.distributed.broadcast(temperature_tensor, 0)
-
-        top_p_tensor = torch.tensor([top_p], dtype=torch.float, device="cuda")
-        torch.distributed.broadcast(top_p_tensor, 0)
-
-        max_new_tokens_tensor = torch.tensor([max_new_tokens], dtype=torch.long, device="cuda")
-        torch.distributed.broadcast(max_new_tokens_tensor, 0)
-
-        def generate_output(prompt, max_gen_len, temperature, top_p, stream_queue):
-            output = generator.generate(
-                [prompt],
-                max_gen_len=max_gen_len,
-                temperature=temperature,
-                top_p=top_p,
-                stop="### User",
-                unitoken_frequency_penalty=0.3,
-                stream_queue=stream_queue,
-            )[0]
-
+        tokenized_prompt = generator.encode_prompt(prompt, max_gen_len=max_new_tokens)
         stream_queue = queue.Queue()
-        generate_thread = threading.Thread(target=generate_output, args=(
-            prompt, max_new_tokens_tensor[0], temperature_tensor[0], top_p_tensor[0], stream_queue))
-        generate_thread.start()
+        request_queue.put((tokenized_prompt, temperature, top_p, max_new_tokens, stream_queue))
 
+        # stream_queue yields (pinned host tokens, cuda event) snapshots, and None when generation is done
+        emitted_ids = []
+        last_decode_time = time.monotonic()
+        latest = None
         while True:
-            words = stream_queue.get()
-            if words is None:
+            item = stream_queue.get()
+            finished = item is None
+            if not finished:
+                latest = item
+                if (latest[0].shape[0] - len(emitted_ids) < STREAM_DECODE_CHUNK
+                        and time.monotonic() - last_decode_time <= STREAM_DECODE_INTERVAL):
+                    continue
+            if latest is None:
                 break
-            output = generator.tokenizer.decode(words[0])
-            output.split("### User")[0].strip()
 
-            if output.endswith("\n\n###") or output.endswith("\n\n##") or output.endswith("\n\n#"):
-                output = output.rsplit("\n\n", 1)[0].strip()
-            yield output
+            stream_tokens, stream_event = latest
+            if stream_tokens.shape[0] > len(emitted_ids):
+                stream_event.synchronize()
+                emitted_ids.extend(stream_tokens[len(emitted_ids):].tolist())
+                last_decode_time = time.monotonic()
+                t = emitted_ids
+                try:
+                    t = t[: t.index(generator.tokenizer.eos_id)]
+                except ValueError:
+                    pass
+                output = generator.tokenizer.decode(t)
+
+                stop_marker = STOP_PATTERN.search(output)
+                if stop_marker is not None:
+                    output = output[:stop_marker.start()].strip()
+                yield output
+
+            if finished:
+                break
 
     def run_fake_evaluate():
         while True:
-            prompt = "Fake prompt"
-            # sync the process with torch.distributed.barrier
-            # TODO(zhiqings): find a better way to sync the processes, and avoid timeout in barrier
-            # torch.distributed.barrier()
-            fake_tensor = torch.zeros(1, dtype=torch.long, device="cuda")
-            torch.distributed.recv(fake_tensor, src=0)
-
-            # sync the prompt string across all processes
-            prompt_tensor = torch.zeros(4096, dtype=torch.long, device="cuda") + generator.tokenizer.pad_id
-            tokenized_prompt = generator.tokenizer.encode(prompt, bos=True, eos=False)
-            prompt_tensor[:len(tokenized_prompt)] = torch.tensor(tokenized_prompt, dtype=torch.long, device="cuda")
-            torch.distributed.broadcast(prompt_tensor, 0)
-            t = prompt_tensor.tolist()
-            try:
-                t = t[: t.index(generator.tokenizer.pad_id)]
-            except ValueError:
-                pass
-            prompt = generator.tokenizer.decode(t)
+            # block on the header broadcast until rank 0 schedules a new batch
+            torch.distributed.broadcast(header_buffer, 0, group=header_group)
+            lengths, temperatures, top_ps, max_new_tokens = parse_header()
 
-            temperature_tensor = torch.tensor([0.0], dtype=torch.float, device="cuda")
-            torch.distributed.broadcast(temperature_tensor, 0)
-
-            top_p_tensor = torch.tensor([0.0], dtype=torch.float, device="cuda")
-            torch.distributed.broadcast(top_p_tensor, 0)
-
-            max_new_tokens_tensor = torch.tensor([0], dtype=torch.long, device="cuda")
-            torch.distributed.broadcast(max_new_tokens_tensor, 0)
+            # sync the prompt token ids across all processes
+            prompt_tensor = prompt_buffer[:sum(lengths)]
+            torch.distributed.broadcast(prompt_tensor, 0)
+            # the prompts stay on the GPU, LLaMA.generate copies them into its token matrix on device
+            prompt_tokens = []
+            offset = 0
+            for length in lengths:
+                prompt_tokens.append(prompt_tensor[offset: offset + length])
+                offset += length
 
             # time.sleep(0.1 * global_rank)
-            output = generator.generate(
-                [prompt],
-                max_gen_len=max_new_tokens_tensor[0],
-                temperature=temperature_tensor[0],
-                top_p=top_p_tensor[0],
-                stop="### User",
-                unitoken_frequency_penalty=0.3,
-            )[0]
+            generate_batch(prompt_tokens, temperatures, top_ps, max_new_tokens)
 
     if global_rank != 0:
         run_fake_evaluate()
 
+    scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
+    scheduler_thread.start()
+
     def inference_chat(
         history,
         chat,
@@ -251,20 +415,20 @@ def main(
         del history[-1]
 
         # history should be prompted by "\n### User\n" and "\n### Watson\n" in an interleaved manner.
-        prompted_history = []
-        for i in range(len(history)):
-            if i % 2 == 0:
-                if i > 0:
-                    prompted_history.append("\n\n### User\n")
-            else:
-                prompted_history.append("\n\n### Dromedary\n")
-            prompted_history.append(history[i])
-        prompted_history = "".join(prompted_history)
+        prompted_history = "".join(
+            turn if i == 0 else ("\n\n### User\n" if i % 2 == 0 else "\n\n### Dromedary\n") + turn
+            for i, turn in enumerate(history)
+        )
         prompted_history = generate_prompt_fn(prompted_history)
         print("Prompt:")
         print(prompted_history)
         history.append(None)
 
+        # the previous turns do not change while streaming, only the last answer does
+        prior_chat = [
+            (history[i], history[i + 1]) for i in range(0, len(history) - 2, 2)
+        ]  # convert to tuples of list
+        output = ""
         for output in evaluate(
             prompted_history,
             temperature=temperature,
@@ -272,10 +436,11 @@ def main(
             max_new_tokens=max_new_tokens,
         ):
             history[-1] = output
-            chat = [
-                (history[i], history[i + 1]) for i in range(0, len(history) - 1, 2)
-            ]  # convert to tuples of list
-            yield [chat, history]
+            yield [prior_chat + [(history[-2], output)], history]
+        if history[-1] is None:
+            # nothing was streamed back, e.g., the generation failed
+            history[-1] = output
+            yield [prior_chat + [(history[-2], output)], history]
         print("Output:")
         print(output)
         print("="*20)
@@ -395,7 +560,8 @@ def main(
             inputs=[chat_input],
         )
 
-    iface.queue(concurrency_count=1, api_open=False, max_size=10)
+    # concurrent chats are batched together by `run_scheduler`
+    iface.queue(concurrency_count=max_batch_size, api_open=False, max_size=10)
     app, _, _ = iface.launch(share=True)
 
 
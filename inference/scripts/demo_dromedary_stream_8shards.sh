@@ -23,5 +23,6 @@ torchrun --nproc_per_node $GPUS_PER_NODE \
   --ckpt_dir $MODEL_DIR/$CKPT_NAME-${N_SHARDS}shards \
   --tokenizer_path $MODEL_DIR/tokenizer.model \
   --max_seq_len 2048 \
-  --max_batch_size 1 \
+  --max_batch_size 4 \
+  --max_shared_seq_len 1536 \
   --meta_prompt_file "../prompts/inference_prompts/dromedary_verbose_prompt.txt"
@@ -9,27 +9,83 @@
 # c[j] is how often that token was sampled prior to the current position
 
 
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, Union
+import numpy as np
 import torch
 import queue
 
 from llama_dromedary.tokenizer import Tokenizer
 from llama_dromedary.model import Transformer
-from collections import defaultdict
+from collections import defaultdict, deque
 
 
 class LLaMA:
-    def __init__(self, model: Transformer, tokenizer: Tokenizer):
+    def __init__(
+        self,
+        model: Transformer,
+        tokenizer: Tokenizer,
+        draft_model: Optional[Transformer] = None,
+        num_speculative_tokens: int = 4,
+    ):
         self.model = model
         self.tokenizer = tokenizer
+        # optional small model with the same tokenizer, used for speculative decoding of single prompts
+        self.draft_model = draft_model
+        self.num_speculative_tokens = num_speculative_tokens
         self.starting_pieces = None
+        self.stop_matchers = {}
+        # token ids of the shared prefix kept in the model's cache by `generate(reuse_prefix_cache=True)`
+        self.prefix_cache_tokens = None
+        # the same for the draft model, whose cache is only used by single-prompt batches
+        self.draft_prefix_cache_tokens = None
 
-    def generate(
+    def _cache_shared_prefix(
         self,
-        prompts: List[str],
+        model: Transformer,
+        tokens: torch.Tensor,
+        shared_prefix_len: int,
+        prefix_cache_tokens: Optional[torch.Tensor],
+    ):
+        # reuse the part of the shared prefix that is still in the cache from the previous call
+        cached_len = 0
+        if prefix_cache_tokens is not None:
+            cached_len = min(shared_prefix_len, prefix_cache_tokens.shape[0])
+            cached_len = _common_prefix_length(tokens[:1, :cached_len], prefix_cache_tokens[None, :cached_len])
+        model.truncate_cache(cached_len)
+
+        # cache (the rest of) the shared prefix
+        if shared_prefix_len > cached_len:
+            model.forward(tokens[:1, cached_len:shared_prefix_len], cached_len, cache_shared_prefix=True)
+
+    def encode_prompt(
+        self,
+        prompt: str,
         max_gen_len: int,
-        temperature: float = 0.8,
-        top_p: float = 0.95,
+        min_gen_len: int = 64,
+    ) -> List[int]:
+        params = self.model.params
+        # Leave at least $min_gen_len tokens for generation
+        max_possible_prompt_len = max(
+            params.max_seq_len + params.max_shared_seq_len - max_gen_len,
+            params.max_seq_len + params.max_shared_seq_len - min_gen_len)
+        while True:
+            t = self.tokenizer.encode(prompt, bos=True, eos=False)
+            if len(t) <= max_possible_prompt_len:
+                return t
+
+            if params.use_prefix_cache:
+                # if use_prefix_cache, we truncate the last paragrpah of prompt
+                prompt = prompt[: prompt.rfind("\n")]
+            else:
+                # if not, We truncate the first paragrpah of prompt
+                prompt = prompt[prompt.find("\n") + 1 :]
+
+    def generate(
+        self,
+        prompts: List[Union[str, List[int], torch.Tensor]],
+        max_gen_len: Union[int, List[int]],
+        temperature: Union[float, List[float]] = 0.8,
+        top_p: Union[float, List[float]] = 0.95,
         min_gen_len: int = 64,
         logit_bias: Optional[Dict[int, float]] = None,
         echo: bool = False,
@@ -38,26 +94,43 @@ class LLaMA:
         bitoken_frequency_penalty: float = 0.0,
         tritoken_frequency_penalty: float = 0.0,
         quadtoken_frequency_penalty: float = 0.0,
-        stream_queue: Optional[queue.Queue] = None,
+        stream_queue: Optional[Union[queue.Queue, List[Optional[queue.Queue]]]] = None,
         frequency_penalty_starts_only: bool = True,
         frequency_penalty_min_range: int = 1024,
+        reuse_prefix_cache: bool = False,
     ) -> List[str]:
         bsz = len(prompts)
         params = self.model.params
         assert bsz <= params.max_batch_size, (bsz, params.max_batch_size)
+
+        # max_gen_len, temperature, top_p and stream_queue can be given per prompt for batched requests
+        max_gen_lens = max_gen_len if isinstance(max_gen_len, (list, tuple)) else [max_gen_len] * bsz
+        assert len(max_gen_lens) == bsz, (len(max_gen_lens), bsz)
+        max_gen_len = max(max_gen_lens)
         assert max_gen_len <= params.max_seq_len, (max_gen_len, params.max_seq_len)
 
-        stop_tokens_v1 = None
-        stop_tokens_v2 = None
-        if stop is not None:
-            assert bsz == 1, "stop is only supported for single prompt generation"
-            stop_tokens_v1 = self.tokenizer.encode(stop, bos=False, eos=False)
-            stop_tokens_v1 = torch.tensor(stop_tokens_v1).long().cuda()
-            stop_tokens_v2 = self.tokenizer.encode("\n" + stop, bos=False, eos=False)[2:]
-            stop_tokens_v2 = torch.tensor(stop_tokens_v2).long().cuda()
+        per_prompt_sampling = isinstance(temperature, (list, tuple)) or isinstance(top_p, (list, tuple))
+        if per_prompt_sampling:
+            temperatures = temperature if isinstance(temperature, (list, tuple)) else [temperature] * bsz
+            top_ps = top_p if isinstance(top_p, (list, tuple)) else [top_p] * bsz
+            assert len(temperatures) == bsz and len(top_ps) == bsz, (len(temperatures), len(top_ps), bsz)
+            temperatures = torch.tensor(temperatures, dtype=torch.float, device="cuda")
+            top_ps = torch.tensor(top_ps, dtype=torch.float, device="cuda").unsqueeze(-1)
 
-        if stream_queue is not None:
-            assert bsz == 1, "stream is only supported for single prompt generation"
+        stream_queues = stream_queue if isinstance(stream_queue, (list, tuple)) else [stream_queue] * bsz
+        assert len(stream_queues) == bsz, (len(stream_queues), bsz)
+        if bsz > 1 and stream_queue is not None and not isinstance(stream_queue, (list, tuple)):
+            raise ValueError("Batched streaming requires one stream_queue per prompt")
+
+        stop_matcher = None
+        if stop is not None:
+            if stop not in self.stop_matchers:
+                # the stop string at the start of a word, and right after a newline
+                stop_tokens_v1 = self.tokenizer.encode(stop, bos=False, eos=False)
+                stop_tokens_v2 = self.tokenizer.encode("\n" + stop, bos=False, eos=False)[2:]
+                self.stop_matchers[stop] = StopTokenMatcher([stop_tokens_v1, stop_tokens_v2])
+            stop_matcher = self.stop_matchers[stop]
+            stop_states = [0] * bsz
 
         if frequency_penalty_starts_only and self.starting_pieces is None:
             self.starting_pieces = self.get_frequency_penalty_set()
@@ -65,22 +138,15 @@ class LLaMA:
         token_seq_freq = [defaultdict(int) for _ in range(bsz)]
 
         prompt_tokens = []
-        for x in prompts:
-            # Leave at least $min_gen_len tokens for generation
-            max_possible_prompt_len = max(
-                params.max_seq_len + params.max_shared_seq_len - max_gen_len,
-                params.max_seq_len + params.max_shared_seq_len - min_gen_len)
-            while True:
-                t = self.tokenizer.encode(x, bos=True, eos=False)
-                if len(t) <= max_possible_prompt_len:
-                    break
-
-                if params.use_prefix_cache:
-                    # if use_prefix_cache, we truncate the last paragrpah of x
-                    x = x[: x.rfind("\n")]
-                else:
-                    # if not, We truncate the first paragrpah of x
-                    x = x[x.find("\n") + 1 :]
+        for x, x_max_gen_len in zip(prompts, max_gen_lens):
+            if isinstance(x, str):
+                t = self.encode_prompt(x, x_max_gen_len, min_gen_len=min_gen_len)
+            elif isinstance(x, torch.Tensor):
+                # 1-D token ids that may already be on the GPU are copied on device below
+                t = x
+            else:
+                # pre-tokenized prompts (e.g., from `encode_prompt`) are used as-is
+                t = list(x)
             prompt_tokens.append(t)
 
         min_prompt_size = min([len(t) for t in prompt_tokens])
@@ -88,21 +154,24 @@ class LLaMA:
 
         # The total length of the input sequence
         total_len = min(params.max_seq_len + params.max_shared_seq_len, max_gen_len + max_prompt_size)
-        tokens = torch.full((bsz, total_len), self.tokenizer.eos_id).cuda().long()
-
+        # stage the prompt tokens in pinned host memory and copy them to the GPU at once
+        host_tokens = np.full((bsz, total_len), self.tokenizer.eos_id, dtype=np.int64)
+        for k, t in enumerate(prompt_tokens):
+            if not isinstance(t, torch.Tensor):
+                host_tokens[k, : len(t)] = t
+        tokens = torch.from_numpy(host_tokens).pin_memory().to("cuda", non_blocking=True)
         for k, t in enumerate(prompt_tokens):
-            tokens[k, : len(t)] = torch.tensor(t).long()
+            if isinstance(t, torch.Tensor):
+                tokens[k, : len(t)] = t
         input_text_mask = tokens != self.tokenizer.eos_id
         start_pos = min_prompt_size
         prev_pos = 0
+        shared_prefix_len = 0
 
         if params.use_prefix_cache:
             # find shared prefix tokens in prompts
-            for cur_pos in range(start_pos - 2):
-                if torch.all(tokens[:, cur_pos] == tokens[0, cur_pos]):
-                    prev_pos = cur_pos + 1
-                else:
-                    break
+            max_shared_len = max(start_pos - 2, 0)
+            prev_pos = _common_prefix_length(tokens[:, :max_shared_len], tokens[:1, :max_shared_len])
 
             # The shared prefix tokens should be less than max_shared_seq_len
             prev_pos = min(prev_pos, params.max_shared_seq_len)
@@ -111,13 +180,28 @@ class LLaMA:
             total_len = min(total_len, params.max_seq_len + prev_pos)
 
             tokens = tokens[:, :total_len]
-            # cache shared prefix
-            if prev_pos > 0:
-                self.model.forward(tokens[:1, :prev_pos], 0, cache_shared_prefix=True)
 
-        for cur_pos in range(start_pos, total_len):
-            logits = self.model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
+            self._cache_shared_prefix(
+                self.model, tokens, prev_pos, self.prefix_cache_tokens if reuse_prefix_cache else None)
+            shared_prefix_len = prev_pos
 
+        stream_buffer = None
+        if stream_queue is not None:
+            # Consumers may still read a finished prompt's tokens while the next batch is generated,
+            # so each call gets its own pinned buffer (cheap thanks to the caching host allocator).
+            stream_buffer = torch.empty((bsz, total_len), dtype=torch.long, device="cpu", pin_memory=True)
+        finished = [False] * bsz
+        # finished prompts keep eos_id after their last token, so that they are cut there when decoding
+        finished_mask = torch.zeros(bsz, dtype=torch.bool, device="cuda")
+
+        frequency_penalties = [
+            (unitoken_frequency_penalty, 0),
+            (bitoken_frequency_penalty, 1),
+            (tritoken_frequency_penalty, 2),
+            (quadtoken_frequency_penalty, 3),
+        ]
+
+        def process_logits(logits, cur_pos, token_seq_freq):
             if logit_bias is not None:
                 for bias_token_id, bias in logit_bias.items():
                     assert bias_token_id < logits.shape[-1]
@@ -127,12 +211,7 @@ class LLaMA:
                     logits[..., bias_token_id] += bias
 
             # Apply frequency penalty
-            for frequency_penalty, history_length in [
-                (unitoken_frequency_penalty, 0),
-                (bitoken_frequency_penalty, 1),
-                (tritoken_frequency_penalty, 2),
-                (quadtoken_frequency_penalty, 3),
-            ]:
+            for frequency_penalty, history_length in frequency_penalties:
                 if frequency_penalty > 0.0:
                     for j in range(bsz):
                         if cur_pos > history_length + len(prompt_tokens[j]):
@@ -160,64 +239,177 @@ class LLaMA:
                                 history_token_freq = torch.tensor(history_token_freq).long().cuda()
                                 logits = logits.clone()
                                 logits[j, history_token_seq] -= frequency_penalty * history_token_freq
+            return logits
 
-            if temperature > 0:
-                probs = torch.softmax(logits / temperature, dim=-1)
-                next_token = sample_top_p(probs, top_p)
-            else:
-                next_token = torch.argmax(logits, dim=-1)
-            next_token = next_token.reshape(-1)
-            # only replace token if prompt has already been generated
-            next_token = torch.where(
-                input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
-            )
-            tokens[:, cur_pos] = next_token
-            prev_pos = cur_pos
-
-            # Update token_seq_freq
-            for frequency_penalty, history_length in [
-                (unitoken_frequency_penalty, 0),
-                (bitoken_frequency_penalty, 1),
-                (tritoken_frequency_penalty, 2),
-                (quadtoken_frequency_penalty, 3),
-            ]:
+        def update_token_seq_freq(cur_pos, token_seq_freq):
+            for frequency_penalty, history_length in frequency_penalties:
                 if frequency_penalty > 0.0:
                     for j in range(bsz):
                         if cur_pos > history_length + len(prompt_tokens[j]):
                             history_prefix = tuple(tokens[j, cur_pos - history_length: cur_pos + 1].tolist())
                             token_seq_freq[j][history_prefix] += 1
 
-            if stop is not None:
-                assert len(prompt_tokens) == 1 and tokens.shape[0] == 1
-                stop_token_len_v1 = stop_tokens_v1.shape[-1]
-                if cur_pos > stop_token_len_v1 + len(prompt_tokens[0]):
-                    if torch.all(tokens[0, cur_pos - stop_token_len_v1 : cur_pos] == stop_tokens_v1):
-                        break
-                stop_token_len_v2 = stop_tokens_v2.shape[-1]
-                if cur_pos > stop_token_len_v2 + len(prompt_tokens[0]):
-                    if torch.all(tokens[0, cur_pos - stop_token_len_v2 : cur_pos] == stop_tokens_v2):
+        def finish_step(cur_pos, next_token_ids):
+            # stop, stream and max_gen_len handling of the tokens just written at cur_pos
+            streamed_rows = []
+            newly_finished_rows = []
+            for j in range(bsz):
+                if finished[j] or cur_pos < len(prompt_tokens[j]):
+                    continue
+
+                if stop_matcher is not None:
+                    stop_states[j] = stop_matcher.step(stop_states[j], next_token_ids[j])
+                    if stop_matcher.is_match(stop_states[j]):
+                        finished[j] = True
+
+                num_gen_tokens = cur_pos + 1 - len(prompt_tokens[j])
+                if not finished[j] and stream_queues[j] is not None:
+                    # Copy the new token into the pinned host buffer without blocking the generation loop,
+                    # and let the consumer synchronize on the event only when it needs the token ids.
+                    stream_buffer[j, num_gen_tokens - 1: num_gen_tokens].copy_(
+                        tokens[j, cur_pos: cur_pos + 1], non_blocking=True)
+                    streamed_rows.append((j, num_gen_tokens))
+
+                if num_gen_tokens >= max_gen_lens[j]:
+                    finished[j] = True
+                if finished[j]:
+                    finished_mask[j] = True
+                    newly_finished_rows.append(j)
+
+            if streamed_rows:
+                # recorded after the copies of all rows, so that it covers each of them
+                stream_event = torch.cuda.Event()
+                stream_event.record()
+                for j, num_gen_tokens in streamed_rows:
+                    stream_queues[j].put((stream_buffer[j, :num_gen_tokens], stream_event))
+            for j in newly_finished_rows:
+                if stream_queues[j] is not None:
+                    stream_queues[j].put(None)
+
+        if self.draft_model is not None and bsz == 1:
+            # Speculative decoding: the draft model proposes up to num_speculative_tokens tokens, which the
+            # model verifies in a single forward pass.
+            spec_temperature = temperatures[0].item() if per_prompt_sampling else temperature
+            spec_top_p = top_ps[0].item() if per_prompt_sampling else top_p
+
+            self._cache_shared_prefix(
+                self.draft_model, tokens, shared_prefix_len,
+                self.draft_prefix_cache_tokens if reuse_prefix_cache else None,
+            )
+            draft_prev_pos = shared_prefix_len
+
+            cur_pos = start_pos
+            while cur_pos < total_len and not finished[0]:
+                num_draft = min(
+                    self.num_speculative_tokens,
+                    total_len - 1 - cur_pos,
+                    max_gen_lens[0] - (cur_pos - len(prompt_tokens[0])) - 1,
+                )
+
+                draft_seq_freq = [defaultdict(int, freq) for freq in token_seq_freq]
+                draft_probs = []
+                for i in range(num_draft):
+                    draft_logits = self.draft_model.forward(tokens[:, draft_prev_pos:cur_pos + i], draft_prev_pos)
+                    draft_prev_pos = cur_pos + i
+                    draft_logits = process_logits(draft_logits, cur_pos + i, draft_seq_freq)
+                    if spec_temperature > 0:
+                        probs = _sampling_probs(draft_logits, spec_temperature, spec_top_p)
+                        draft_token = torch.multinomial(probs, num_samples=1).reshape(-1)
+                        draft_probs.append(probs)
+                    else:
+                        draft_token = torch.argmax(draft_logits, dim=-1)
+                    tokens[:, cur_pos + i] = draft_token
+                    update_token_seq_freq(cur_pos + i, draft_seq_freq)
+                draft_token_ids = tokens[0, cur_pos:cur_pos + num_draft].tolist()
+
+                all_logits = self.model.forward(
+                    tokens[:, prev_pos:cur_pos + num_draft], prev_pos, return_all_logits=True)
+                all_logits = all_logits[:, -(num_draft + 1):]
+
+                for i in range(num_draft + 1):
+                    pos = cur_pos + i
+                    logits = process_logits(all_logits[:, i], pos, token_seq_freq)
+                    accepted = False
+                    if spec_temperature > 0:
+                        probs = _sampling_probs(logits, spec_temperature, spec_top_p)
+                        if i < num_draft:
+                            draft_token = draft_token_ids[i]
+                            # accept the draft token with probability min(1, p / q)
+                            accepted = (torch.rand(1, device=probs.device) * draft_probs[i][0, draft_token]
+                                        <= probs[0, draft_token]).item()
+                            if not accepted:
+                                # resample from the residual distribution max(0, p - q)
+                                residual = (probs - draft_probs[i]).clamp(min=0.0)
+                                if residual.sum().item() > 0:
+                                    probs = residual / residual.sum(dim=-1, keepdim=True)
+                        next_token = draft_token if accepted else torch.multinomial(probs, num_samples=1).item()
+                    else:
+                        next_token = torch.argmax(logits, dim=-1).item()
+                        accepted = i < num_draft and next_token == draft_token_ids[i]
+
+                    tokens[0, pos] = next_token
+                    update_token_seq_freq(pos, token_seq_freq)
+                    finish_step(pos, [next_token])
+                    if finished[0] or not accepted:
                         break
 
-            if stream_queue is not None:
-                assert len(prompt_tokens) == 1 and tokens.shape[0] == 1
-                if cur_pos > len(prompt_tokens[0]):
-                    stream_tokens = tokens[0, len(prompt_tokens[0]): cur_pos].tolist()
-                    try:
-                        stream_tokens = stream_tokens[: stream_tokens.index(self.tokenizer.eos_id)]
-                    except ValueError:
-                        pass
-                    stream_queue.put((stream_tokens, ))
+                # positions after the last accepted token are recomputed in the next round
+                prev_pos = pos
+                draft_prev_pos = min(draft_prev_pos, pos)
+                cur_pos = pos + 1
+
+            # drop the rejected draft tokens after the last generated one
+            tokens[0, cur_pos:] = self.tokenizer.eos_id
+            if reuse_prefix_cache:
+                self.draft_prefix_cache_tokens = tokens[0, :shared_prefix_len].clone()
+            else:
+                self.draft_prefix_cache_tokens = None
+                self.draft_model.clear_cache()
+        else:
+            for cur_pos in range(start_pos, total_len):
+                logits = self.model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
+                logits = process_logits(logits, cur_pos, token_seq_freq)
+
+                if per_prompt_sampling:
+                    probs = torch.softmax(logits / temperatures.clamp(min=1e-5).unsqueeze(-1), dim=-1)
+                    next_token = torch.where(
+                        temperatures > 0, sample_top_p(probs, top_ps).reshape(-1), torch.argmax(logits, dim=-1)
+                    )
+                elif temperature > 0:
+                    probs = torch.softmax(logits / temperature, dim=-1)
+                    next_token = sample_top_p(probs, top_p)
+                else:
+                    next_token = torch.argmax(logits, dim=-1)
+                next_token = next_token.reshape(-1)
+                # only replace token if prompt has already been generated
+                next_token = torch.where(
+                    input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
+                )
+                next_token = torch.where(finished_mask, self.tokenizer.eos_id, next_token)
+                tokens[:, cur_pos] = next_token
+                prev_pos = cur_pos
+
+                # Update token_seq_freq
+                update_token_seq_freq(cur_pos, token_seq_freq)
+
+                finish_step(cur_pos, next_token.tolist() if stop_matcher is not None else None)
+                if all(finished):
+                    break
 
         if params.use_prefix_cache:
-            self.model.clear_cache()
+            if reuse_prefix_cache:
+                self.prefix_cache_tokens = tokens[0, :shared_prefix_len].clone()
+            else:
+                self.prefix_cache_tokens = None
+                self.model.clear_cache()
 
         decoded = []
         for i, t in enumerate(tokens.tolist()):
             # cut to max gen len
             if echo:
-                t = t[: len(prompt_tokens[i]) + max_gen_len]
+                t = t[: len(prompt_tokens[i]) + max_gen_lens[i]]
             else:
-                t = t[len(prompt_tokens[i]): len(prompt_tokens[i]) + max_gen_len]
+                t = t[len(prompt_tokens[i]): len(prompt_tokens[i]) + max_gen_lens[i]]
             # cut to eos tok if any
             try:
                 t = t[: t.index(self.tokenizer.eos_id)]
@@ -225,8 +417,9 @@ class LLaMA:
                 pass
             decoded.append(self.tokenizer.decode(t))
 
-        if stream_queue is not None:
-            stream_queue.put(None)
+        for j in range(bsz):
+            if not finished[j] and stream_queues[j] is not None:
+                stream_queues[j].put(None)
 
         return decoded
 
@@ -262,6 +455,10 @@ class LLaMA:
 
         shared_prefix_len = 0
         if params.use_prefix_cache:
+            # the shared prefix cache is overwritten below
+            self.prefix_cache_tokens = None
+            self.model.clear_cache()
+
             # find shared prefix tokens in prompts
             for cur_pos in range(min_prompt_size - 2):
                 if torch.all(tokens[:, cur_pos] == tokens[0, cur_pos]):
@@ -317,6 +514,64 @@ class LLaMA:
         return starting_pieces
 
 
+class StopTokenMatcher:
+    """Aho-Corasick automaton over token ids, fed one generated token at a time."""
+
+    def __init__(self, stop_sequences: List[List[int]]):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [False]
+        for stop_tokens in stop_sequences:
+            state = 0
+            for token in stop_tokens:
+                if token not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(False)
+                    self.goto[state][token] = len(self.goto) - 1
+                state = self.goto[state][token]
+            self.output[state] = True
+
+        # failure links, in breadth-first order
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for token, next_state in self.goto[state].items():
+                pending.append(next_state)
+                fail = self.fail[state]
+                while fail != 0 and token not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(token, 0)
+                self.output[next_state] = self.output[next_state] or self.output[self.fail[next_state]]
+
+    def step(self, state: int, token: int) -> int:
+        while state != 0 and token not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(token, 0)
+
+    def is_match(self, state: int) -> bool:
+        return self.output[state]
+
+
+def _common_prefix_length(tokens: torch.Tensor, prefix: torch.Tensor) -> int:
+    """Length of the longest prefix shared by all rows of tokens and prefix (broadcast over rows)."""
+    if tokens.shape[-1] == 0:
+        return 0
+    matched = torch.all(tokens == prefix, dim=0).int()
+    return int(torch.cumprod(matched, dim=0).sum().item())
+
+
+def _sampling_probs(logits: torch.Tensor, temperature: float, top_p: float) -> torch.Tensor:
+    """The distribution `sample_top_p` samples from, over the whole vocabulary."""
+    probs = torch.softmax(logits / temperature, dim=-1)
+    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+    probs_sum = torch.cumsum(probs_sort, dim=-1)
+    mask = probs_sum - probs_sort > top_p
+    probs_sort[mask] = 0.0
+    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
+    return torch.zeros_like(probs).scatter_(-1, probs_idx, probs_sort)
+
+
 def sample_top_p(probs, p):
     probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
     probs_sum = torch.cumsum(probs_sort, dim=-1)
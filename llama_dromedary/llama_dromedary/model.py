@@ -17,6 +17,17 @@ from fairscale.nn.model_parallel.layers import (
     VocabParallelEmbedding,
 )
 
+try:
+    import flash_attn
+    from flash_attn import flash_attn_func
+
+    # flash-attn<2.1 aligns the causal mask to the top-left corner, which is wrong when the queries
+    # follow cached keys
+    if tuple(int(v) for v in flash_attn.__version__.split(".")[:2]) < (2, 1):
+        flash_attn_func = None
+except ImportError:
+    flash_attn_func = None
+
 
 @dataclass
 class ModelArgs:
@@ -35,20 +46,30 @@ class ModelArgs:
     max_shared_seq_len: int = 0
     use_prefix_cache: bool = False
     disable_cache: bool = False
+    use_torch_compile: bool = False
+    use_flash_attn: bool = False
+
+
+def rms_norm(x: torch.Tensor, weight: torch.Tensor, eps: float):
+    x_float = x.float()
+    output = (x_float * torch.rsqrt(x_float.pow(2).mean(-1, keepdim=True) + eps)).type_as(x)
+    return output * weight
+
+
+def swiglu(x1: torch.Tensor, x3: torch.Tensor):
+    return F.silu(x1) * x3
 
 
 class RMSNorm(torch.nn.Module):
+    _rms_norm = staticmethod(rms_norm)
+
     def __init__(self, dim: int, eps: float = 1e-6):
         super().__init__()
         self.eps = eps
         self.weight = nn.Parameter(torch.ones(dim))
 
-    def _norm(self, x):
-        return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
-
     def forward(self, x):
-        output = self._norm(x.float()).type_as(x)
-        return output * self.weight
+        return self._rms_norm(x, self.weight, self.eps)
 
 
 def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
@@ -120,6 +141,8 @@ class Attention(nn.Module):
             init_method=lambda x: x,
         )
 
+        self.use_flash_attn = args.use_flash_attn
+
         self.disable_cache = args.disable_cache
         if not self.disable_cache:
             self.cache_k = torch.zeros(
@@ -207,15 +230,22 @@ class Attention(nn.Module):
                         dim=1,
                     )
         else:
+            # cache a new shared prefix, or extend the one already cached
             assert self.shared_cache_k is not None
-            assert start_pos == 0
+            assert start_pos == 0 or start_pos == self.shared_prefix_length, (start_pos, self.shared_prefix_length)
             self.shared_cache_k = self.shared_cache_k.to(xq)
             self.shared_cache_v = self.shared_cache_v.to(xq)
-            self.shared_cache_k[:, :seqlen] = xk
-            self.shared_cache_v[:, :seqlen] = xv
-            self.shared_prefix_length = seqlen
-            keys = xk
-            values = xv
+            self.shared_cache_k[:, start_pos : start_pos + seqlen] = xk
+            self.shared_cache_v[:, start_pos : start_pos + seqlen] = xv
+            self.shared_prefix_length = start_pos + seqlen
+            keys = self.shared_cache_k[:, : start_pos + seqlen]
+            values = self.shared_cache_v[:, : start_pos + seqlen]
+
+        if self.use_flash_attn:
+            # The causal mask of flash-attn>=2.1 is aligned to the bottom-right corner, i.e., the queries
+            # attend to all cached keys, like the mask below.
+            output = flash_attn_func(xq, keys, values, causal=mask is not None)
+            return self.wo(output.contiguous().view(bsz, seqlen, -1))
 
         xq = xq.transpose(1, 2)
         keys = keys.transpose(1, 2)
@@ -243,6 +273,8 @@ class Attention(nn.Module):
 
 
 class FeedForward(nn.Module):
+    _swiglu = staticmethod(swiglu)
+
     def __init__(
         self,
         dim: int,
@@ -264,7 +296,7 @@ class FeedForward(nn.Module):
         )
 
     def forward(self, x):
-        return self.w2(F.silu(self.w1(x)) * self.w3(x))
+        return self.w2(self._swiglu(self.w1(x), self.w3(x)))
 
 
 class TransformerBlock(nn.Module):
@@ -310,6 +342,10 @@ class Transformer(nn.Module):
                 params.vocab_size, params.dim, init_method=lambda x: x
             )
 
+        if params.use_flash_attn and flash_attn_func is None:
+            print("flash_attn>=2.1 is not installed, falling back to the default attention")
+            params.use_flash_attn = False
+
         self.layers = torch.nn.ModuleList()
         for layer_id in range(params.n_layers):
             self.layers.append(TransformerBlock(layer_id, params))
@@ -334,6 +370,18 @@ class Transformer(nn.Module):
                 self.params.qkv_dim // self.params.n_heads, (self.params.max_seq_len + self.params.max_shared_seq_len)  * 2
             )
 
+        if params.use_torch_compile:
+            # Fuse the element-wise ops around the parallel matmuls, which otherwise launch a handful of
+            # small kernels each per layer and decode step. The functions are compiled once and shared
+            # by all layers; dynamic shapes avoid recompiling for every prompt length.
+            compiled_rms_norm = torch.compile(rms_norm, dynamic=True)
+            compiled_swiglu = torch.compile(swiglu, dynamic=True)
+            for module in self.modules():
+                if isinstance(module, RMSNorm):
+                    module._rms_norm = compiled_rms_norm
+                elif isinstance(module, FeedForward):
+                    module._swiglu = compiled_swiglu
+
     @torch.inference_mode()
     def forward(self, tokens: torch.Tensor, start_pos: int,
                 cache_shared_prefix: bool = False, return_all_logits: bool = False):
@@ -364,5 +412,10 @@ class Transformer(nn.Module):
         return output.float()
 
     def clear_cache(self):
+        self.truncate_cache(0)
+
+    def truncate_cache(self, shared_prefix_length: int):
+        # keep only the first shared_prefix_length tokens of the cached shared prefix
         for layer in self.layers:
-            layer.attention.shared_prefix_length = 0
+            assert shared_prefix_length <= layer.attention.shared_prefix_length
+            layer.attention.shared_prefix_length = shared_prefix_length
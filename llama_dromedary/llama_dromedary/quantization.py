@@ -0,0 +1,98 @@
+"""Weight-only quantization of the model parallel linear layers."""
+import torch
+from torch import nn
+
+from fairscale.nn.model_parallel.layers import ColumnParallelLinear, RowParallelLinear
+from fairscale.nn.model_parallel.mappings import (
+    copy_to_model_parallel_region,
+    gather_from_model_parallel_region,
+    reduce_from_model_parallel_region,
+    scatter_to_model_parallel_region,
+)
+
+from llama_dromedary.model import Transformer
+
+try:
+    import bitsandbytes as bnb
+except ImportError:
+    bnb = None
+
+
+QUANTIZATION_MODES = ("none", "int8", "int4")
+
+
+class QuantizedParallelLinear(nn.Module):
+    """
+    Drop-in replacement for fairscale's ColumnParallelLinear / RowParallelLinear that keeps the
+    local weight partition in int8 (LLM.int8()) or int4 (NF4) with fp16 compute.
+    """
+
+    def __init__(self, layer: nn.Module, quantization: str):
+        super().__init__()
+        assert layer.bias is None, "Only bias-free parallel linear layers are supported"
+        self.is_column_parallel = isinstance(layer, ColumnParallelLinear)
+        self.gather_output = getattr(layer, "gather_output", False)
+        self.input_is_parallel = getattr(layer, "input_is_parallel", True)
+
+        weight = layer.weight.data
+        device = weight.device
+        out_features, in_features = weight.shape
+
+        # bitsandbytes quantizes the weight when it is moved from CPU to GPU
+        if quantization == "int8":
+            self.linear = bnb.nn.Linear8bitLt(
+                in_features, out_features, bias=False, has_fp16_weights=False, threshold=6.0
+            )
+            self.linear.weight = bnb.nn.Int8Params(
+                weight.cpu(), requires_grad=False, has_fp16_weights=False
+            ).cuda(device)
+        elif quantization == "int4":
+            self.linear = bnb.nn.Linear4bit(
+                in_features, out_features, bias=False, compute_dtype=torch.float16, quant_type="nf4"
+            )
+            self.linear.weight = bnb.nn.Params4bit(
+                weight.cpu(), requires_grad=False, quant_type="nf4"
+            ).cuda(device)
+        else:
+            raise ValueError(f"Unknown quantization: {quantization}")
+
+    def forward(self, x: torch.Tensor):
+        if self.is_column_parallel:
+            output = self.linear(copy_to_model_parallel_region(x))
+            if self.gather_output:
+                output = gather_from_model_parallel_region(output)
+        else:
+            if not self.input_is_parallel:
+                x = scatter_to_model_parallel_region(x)
+            output = reduce_from_model_parallel_region(self.linear(x))
+        return output
+
+
+def quantize_model(model: Transformer, quantization: str) -> Transformer:
+    """
+    Quantize the attention and feed-forward projections of a loaded fp16 model in place.
+
+    The embeddings, norms and the output projection are kept in fp16. The fp16 weights of the
+    quantized layers are released once they are replaced.
+
+    Args:
+        model: fp16 model with its checkpoint already loaded
+        quantization: one of "none", "int8", "int4"
+
+    Returns:
+        the quantized model
+    """
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization: {quantization}, should be one of {QUANTIZATION_MODES}")
+    if quantization == "none":
+        return model
+    if bnb is None:
+        raise ImportError("bitsandbytes is required for int8/int4 quantization")
+
+    for layer in model.layers:
+        for module in (layer.attention, layer.feed_forward):
+            for name, child in list(module.named_children()):
+                if isinstance(child, (ColumnParallelLinear, RowParallelLinear)):
+                    setattr(module, name, QuantizedParallelLinear(child, quantization))
+    torch.cuda.empty_cache()
+    return model
@@ -4,14 +4,16 @@ import os
 import torch
 import time
 import json
+import collections
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from fairscale.nn.model_parallel import initialize as mpu
 from fairscale.nn.model_parallel.initialize import initialize_model_parallel
 
 from llama_dromedary.generation import LLaMA
-from llama_dromedary.model import ModelArgs, Transformer
+from llama_dromedary.model import ModelArgs, RMSNorm, Transformer
 from llama_dromedary.tokenizer import Tokenizer
 
 
@@ -35,6 +37,106 @@ def sync_model_parallel():
     torch.distributed.barrier()
 
 
+def _load_checkpoint_file(ckpt_path: str) -> Dict[str, torch.Tensor]:
+    try:
+        return torch.load(ckpt_path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # torch<2.1 or a checkpoint not saved in the zipfile format
+        return torch.load(ckpt_path, map_location="cpu")
+
+
+def load_checkpoint(
+    model: Transformer,
+    ckpt_path: str,
+    num_prefetch: int = 4,
+):
+    """
+    Load a checkpoint shard into a model whose parameters are already allocated on GPU.
+
+    The shard is memory-mapped, and a thread pool reads the next tensors into pinned host memory
+    while the previous ones are copied to the GPU with non-blocking copies on a dedicated stream.
+    Keys that are not in the model are ignored, as with `load_state_dict(strict=False)`.
+
+    Args:
+        model: model to load the weights into
+        ckpt_path: path to the checkpoint shard
+        num_prefetch: number of tensors to read ahead of the host-to-device copies
+    """
+    checkpoint = _load_checkpoint_file(ckpt_path)
+
+    state_dict = model.state_dict()
+    copy_stream = torch.cuda.Stream()
+    # parameter initialization on the default stream must finish before it is overwritten
+    copy_stream.wait_stream(torch.cuda.current_stream())
+
+    def copy_to_model(key, pinned_future):
+        pinned_tensor = pinned_future.result()
+        assert state_dict[key].shape == pinned_tensor.shape, (key, state_dict[key].shape, pinned_tensor.shape)
+        state_dict[key].copy_(pinned_tensor, non_blocking=True)
+
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=num_prefetch) as executor, torch.cuda.stream(copy_stream):
+        for key, tensor in checkpoint.items():
+            if key not in state_dict:
+                continue
+            pending.append((key, executor.submit(tensor.pin_memory)))
+            if len(pending) > num_prefetch:
+                copy_to_model(*pending.popleft())
+        while pending:
+            copy_to_model(*pending.popleft())
+    copy_stream.synchronize()
+
+
+def broadcast_checkpoint(
+    model: Transformer,
+    ckpt_paths: List[str],
+    global_rank: int,
+):
+    """
+    Read all checkpoint shards on rank 0 and send them to the other model parallel ranks with NCCL.
+
+    Only rank 0 touches the file system, instead of every rank reading its own shard at the same time.
+    Sharded parameters are scattered to their ranks, and the replicated RMSNorm weights are broadcast
+    from the first shard. Keys that are not in the model are ignored, as with `load_checkpoint`.
+
+    Args:
+        model: model to load the weights into, with its parameters already allocated on GPU
+        ckpt_paths: paths to the checkpoint shards of all ranks, in rank order
+        global_rank: rank of this process
+    """
+    world_size = torch.distributed.get_world_size()
+    assert len(ckpt_paths) == world_size, (len(ckpt_paths), world_size)
+
+    state_dict = model.state_dict()
+    replicated_keys = set(
+        f"{name}.weight" for name, module in model.named_modules() if isinstance(module, RMSNorm)
+    )
+
+    checkpoints = None
+    keys = [None]
+    if global_rank == 0:
+        checkpoints = [_load_checkpoint_file(ckpt_path) for ckpt_path in ckpt_paths]
+        keys = [[key for key in checkpoints[0] if key in state_dict]]
+    torch.distributed.broadcast_object_list(keys, src=0)
+
+    for key in keys[0]:
+        param = state_dict[key]
+        if key in replicated_keys:
+            if global_rank == 0:
+                param.copy_(checkpoints[0][key].pin_memory(), non_blocking=True)
+            torch.distributed.broadcast(param, src=0)
+        else:
+            scatter_list = None
+            if global_rank == 0:
+                scatter_list = []
+                for checkpoint in checkpoints:
+                    assert param.shape == checkpoint[key].shape, (key, param.shape, checkpoint[key].shape)
+                    scatter_list.append(
+                        checkpoint[key].pin_memory().to(param.device, dtype=param.dtype, non_blocking=True))
+            torch.distributed.scatter(param, scatter_list, src=0)
+    torch.cuda.synchronize()
+
+
 def load_model(
     ckpt_dir: str,
     tokenizer_path: str,
@@ -52,7 +154,6 @@ def load_model(
     ), f"Loading a checkpoint for MP={len(checkpoints)} but world size is {world_size}"
     ckpt_path = checkpoints[global_rank]
     print("Loading")
-    checkpoint = torch.load(ckpt_path, map_location="cpu")
     with open(Path(ckpt_dir) / "params.json", "r") as f:
         params = json.loads(f.read())
 
@@ -73,9 +174,10 @@ def load_model(
 
     torch.set_default_tensor_type(torch.cuda.HalfTensor)
     model = Transformer(model_args)
-    model.load_state_dict(checkpoint, strict=False)
+    load_checkpoint(model, ckpt_path)
     model.eval()
-    model.half()
+    # parameters are already fp16 because of the default tensor type above
+    assert next(model.parameters()).dtype == torch.float16
 
     generator = LLaMA(model, tokenizer)
     print(f"Loaded in {time.time() - start_time:.2f} seconds")